@@ -1,8 +1,21 @@
 import os
+import asyncio
+import hashlib
+import json
 import logging
+import queue
+import re
+import tempfile
+import threading
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import requests
+from typing import BinaryIO
+import httpx
+import tiktoken
 import base64
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 import fitz  # PyMuPDF
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -15,28 +28,177 @@ import streamlit as st
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-file_handler = logging.FileHandler('lesson_plan_generator.log')
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+# Get the root logger; Streamlit re-executes this module on every
+# interaction against the same process-global logger, so only register the
+# queue handler and start its listener thread once
+logger = logging.getLogger()
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+if not any(isinstance(h, QueueHandler) for h in logger.handlers):
+    file_handler = logging.FileHandler('lesson_plan_generator.log')
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 
-# Get the root logger and attach handlers
-logger = logging.getLogger()
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+
+    # Route records through a queue so the hot path only pays a queue.put per
+    # log call; a background listener thread does the actual file/console writes
+    log_queue = queue.Queue(-1)
+    log_listener = QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+
+    logger.addHandler(QueueHandler(log_queue))
 
 # Set the DeepInfra API key from environment variables
 deep_infra_api_key = os.getenv("DEEP_INFRA_API_KEY", "VxCqTQoMdguLd8Tp6m3U4CcFz7Jc3bZ0")
 base_url = "https://api.deepinfra.com/v1/openai"
 
-# Function to extract text from uploaded document (PDF)
+# One pooled HTTP client per event loop, so every call after the first reuses
+# the TCP+TLS connection to api.deepinfra.com instead of re-handshaking.
+# Streamlit runs each pipeline under a fresh asyncio.run loop, and httpx
+# connections are bound to the loop they were opened on, so the pool is keyed
+# by loop rather than held in a single module global.
+_http_clients = {}
+
+def get_http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            http2=True,
+            timeout=120,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            headers={"Authorization": f"Bearer {deep_infra_api_key}"},
+        )
+        _http_clients[loop] = client
+    return client
+
+async def run_with_http_client(coro):
+    """Await a pipeline coroutine, closing the loop's pooled client on exit.
+
+    Each asyncio.run call uses a fresh event loop that dies with the call, so
+    without an explicit aclose() every Streamlit rerun would strand a client
+    with open TLS connections until GC gets to it.
+    """
+    try:
+        return await coro
+    finally:
+        client = _http_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+# Retry policy for the DeepInfra calls: transient 429/5xx responses and
+# timeouts are retried with jittered exponential backoff (honoring a numeric
+# Retry-After when the server sends one); 4xx client errors fail immediately.
+# Five attempts bound the worst case to about two minutes before reraising.
+def _is_transient_api_error(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        return code == 429 or code >= 500
+    return False
+
+def _api_wait(retry_state):
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(int(retry_after), 30)
+    return wait_exponential_jitter(initial=1, max=30)(retry_state)
+
+api_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=_api_wait,
+    retry=retry_if_exception(_is_transient_api_error),
+    reraise=True,
+)
+
+# On-disk cache for API responses, keyed by content hash. Re-uploading the
+# same chapter then costs zero tokens and returns in milliseconds.
+# Bump CACHE_VERSION whenever the prompt template or image handling changes.
+CACHE_VERSION = "3"
+cache_dir = "./.cache"
+
+def _cache_key(*parts: str) -> str:
+    return hashlib.sha256("\x00".join((CACHE_VERSION,) + parts).encode()).hexdigest()
+
+def _atomic_write(path: str, data: bytes):
+    # Write to a temp file in the target directory and os.replace() it into
+    # place: a crash or a concurrent session mid-write can never leave a
+    # truncated file that later reads would keep serving as valid bytes
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _cache_get(key: str) -> bytes:
+    try:
+        with open(os.path.join(cache_dir, key), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _cache_put(key: str, data: bytes):
+    _atomic_write(os.path.join(cache_dir, key), data)
+
+# Per-upload job checkpoints. The job id is the hash of the uploaded PDF
+# bytes; the plan is persisted as soon as the LLM finishes and each image as
+# it arrives, so a retry after a mid-pipeline failure resumes from whatever
+# already completed instead of redoing the LLM and earlier image calls.
+jobs_dir = "./jobs"
+
+def job_id_for(pdf_file: bytes) -> str:
+    return hashlib.sha256(pdf_file).hexdigest()[:16]
+
+def _job_get(job_id: str, name: str) -> bytes:
+    try:
+        with open(os.path.join(jobs_dir, job_id, name), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _job_put(job_id: str, name: str, data: bytes):
+    _atomic_write(os.path.join(jobs_dir, job_id, name), data)
+
+# Text extraction flags: we only need a raw text dump for the LLM, so skip
+# dehyphenation and mediabox clipping, which cost extra per-page layout work
+# without changing what the model sees.
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_DEHYPHENATE & ~fitz.TEXT_MEDIABOX_CLIP
+
+# Function to extract text from uploaded document (PDF). Pages are extracted
+# on a thread pool: fitz releases the GIL inside get_text, so multi-page PDFs
+# scale near-linearly with cores. A fitz.Document is not thread-safe, so each
+# pool thread lazily opens its own document over the same immutable source
+# bytes and reuses it for all of its pages. ex.map preserves page order.
 def extract_text_from_pdf(pdf_file: bytes) -> str:
     logger.info("Starting PDF text extraction")
+    local = threading.local()
+    worker_docs = []
+
+    def extract_page(page_number: int) -> str:
+        doc = getattr(local, "doc", None)
+        if doc is None:
+            doc = local.doc = fitz.open(stream=pdf_file, filetype="pdf")
+            worker_docs.append(doc)
+        return doc.load_page(page_number).get_text("text", flags=TEXT_FLAGS)
+
     try:
-        doc = fitz.open(stream=pdf_file, filetype="pdf")
-        text = "".join([page.get_text("text") for page in doc])
+        with fitz.open(stream=pdf_file, filetype="pdf") as doc:
+            page_count = doc.page_count
+        try:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                texts = list(ex.map(extract_page, range(page_count)))
+        finally:
+            for doc in worker_docs:
+                doc.close()
+        text = "".join(texts)
         logger.info("Successfully extracted text from the PDF")
         return text
     except Exception as e:
@@ -44,13 +206,11 @@ def extract_text_from_pdf(pdf_file: bytes) -> str:
         st.error(f"PDF extraction failed: {str(e)}")
         return ""
 
-# Function to generate lesson plan using DeepInfra model
-def generate_lesson_plan(extracted_text: str) -> str:
-    logger.info("Starting lesson plan generation with DeepInfra")
-    prompt = f"""
-    Based on the following textbook chapter content:
-
-{extracted_text}
+# Static instructions for the lesson plan prompt. Kept as a byte-identical
+# module-level constant and sent as the system message so the provider-side
+# prompt cache can match it as a prefix; only the chapter text varies per
+# request (as the user message). Never interpolate variable data in here.
+SYSTEM_PROMPT = """You will be given the content of a textbook chapter.
 
 Please generate a comprehensive lesson plan for teachers, structured into three distinct sections:
 
@@ -73,99 +233,323 @@ Output Format:
 Activity Name: Provide a creative name for the activity.
 Bullet Points: Describe the steps or materials required for the activity.
 Objective: Explain how the activity supports learning and connects to the chapter’s content.
-Debrief: Summarize the activity and link it back to the key concepts learned in the lesson.
-    """
-    
-    response = requests.post(
-        f"{base_url}/chat/completions",
-        headers={"Authorization": f"Bearer {deep_infra_api_key}"},
-        json={"model": "meta-llama/Meta-Llama-3-70B-Instruct", "messages": [{"role": "user", "content": prompt}], "max_tokens": 10000}
-    )
-    response.raise_for_status()
-    lesson_plan = response.json()['choices'][0]['message']['content'].strip()
+Debrief: Summarize the activity and link it back to the key concepts learned in the lesson."""
+
+# One "heading: content" section per "\n\n"-separated block of the lesson
+# plan. Compiled once; a single finditer pass replaces the old
+# split("\n\n") / "in" / split(":", 1) chain and its intermediate strings.
+# The post-colon whitespace class must not include "\n", or a bare
+# colon-terminated line (an LLM lead-in like "Here is your lesson plan:")
+# would swallow the "\n\n" boundary and the entire next section with it.
+SECTION_RE = re.compile(r"(?m)^([^\n:]+):[ \t]*(.*?)(?=\n\n[^\n:]+:|\Z)", re.S)
+
+@dataclass(frozen=True)
+class Section:
+    """One parsed lesson-plan section, fully split at parse time so rendering
+    never re-inspects strings: multi-line content becomes bullets, single-line
+    content a paragraph. `content` is the raw text used as the image prompt."""
+    heading: str
+    content: str
+    paragraphs: tuple
+    bullets: tuple
+
+def parse_sections(text: str) -> list:
+    """Return a Section for every "heading: content" block of a lesson plan."""
+    sections = []
+    for m in SECTION_RE.finditer(text):
+        content = m.group(2).strip()
+        lines = content.split("\n")
+        if len(lines) > 1:
+            paragraphs, bullets = (), tuple(line.strip() for line in lines)
+        else:
+            paragraphs, bullets = (content,), ()
+        sections.append(Section(m.group(1).strip(), content, paragraphs, bullets))
+    return sections
+
+# Input token budget for the chapter text. Long chapters pay quadratic
+# attention cost server-side and dominate pipeline latency, so anything over
+# budget keeps the chapter opening plus its ending (intro + summary).
+INPUT_TOKEN_BUDGET = 8000
+HEAD_TOKENS = 6000
+TAIL_TOKENS = 2000
+
+def clip_to_token_budget(text: str) -> str:
+    enc = tiktoken.get_encoding("cl100k_base")
+    tokens = enc.encode(text)
+    if len(tokens) <= INPUT_TOKEN_BUDGET:
+        return text
+    logger.info(f"Clipping chapter text from {len(tokens)} to {INPUT_TOKEN_BUDGET} tokens")
+    return enc.decode(tokens[:HEAD_TOKENS]) + "\n\n[...]\n\n" + enc.decode(tokens[-TAIL_TOKENS:])
+
+# Function to generate lesson plan using DeepInfra model.
+# The completion is streamed so that, as soon as a section is fully decoded
+# (a "\n\n" boundary with a "heading:" line), its image request is dispatched
+# in the background - overlapping image latency with the remaining LLM decode.
+@api_retry
+async def generate_lesson_plan(extracted_text: str, *, with_images: bool = True) -> tuple:
+    logger.info("Starting lesson plan generation with DeepInfra")
+    model = "meta-llama/Meta-Llama-3-70B-Instruct"
+    extracted_text = clip_to_token_budget(extracted_text)
+    buffer = ""
+    parsed_upto = 0
+    image_tasks = []
+    task_prompts = []
+
+    def dispatch_sections(chunk: str):
+        # Schedule an image request for every newly-completed section
+        if not with_images:
+            return
+        for section in parse_sections(chunk):
+            task_prompts.append(section.content)
+            image_tasks.append(asyncio.create_task(generate_image_from_text(section.content)))
+
+    cached = _cache_get(_cache_key("llm", model, extracted_text))
+    if cached is not None:
+        logger.info("Lesson plan served from cache")
+        lesson_plan = cached.decode("utf-8")
+        dispatch_sections(lesson_plan)
+        return lesson_plan, image_tasks
+
+    try:
+        async with get_http_client().stream(
+            "POST",
+            f"{base_url}/chat/completions",
+            json={"model": model, "messages": [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": extracted_text}], "max_tokens": 10000, "stream": True}
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)['choices'][0].get('delta', {})
+                buffer += delta.get('content') or ""
+
+                # Hand off every section that is now complete (ends at the last "\n\n")
+                boundary = buffer.rfind("\n\n")
+                if boundary > parsed_upto:
+                    dispatch_sections(buffer[parsed_upto:boundary])
+                    parsed_upto = boundary + 2
+    except BaseException:
+        # A failure mid-stream must not leave this attempt's image tasks
+        # running: the retry wrapping this function re-enters with a fresh
+        # image_tasks list, so orphaned tasks would duplicate FLUX calls and
+        # die unretrieved at loop teardown. Cancel and reap them first.
+        for task in image_tasks:
+            task.cancel()
+        await asyncio.gather(*image_tasks, return_exceptions=True)
+        raise
+
+    lesson_plan = buffer.strip()
+    # The final section has no trailing "\n\n"; dispatch whatever remains
+    if buffer[parsed_upto:].strip():
+        dispatch_sections(buffer[parsed_upto:])
+    _cache_put(_cache_key("llm", model, extracted_text), lesson_plan.encode("utf-8"))
     logger.info("Lesson plan successfully generated")
-    return lesson_plan
 
-# Function to generate images based on the lesson plan content
-def generate_image_from_text(text: str) -> BytesIO:
-    logger.info("Starting image generation")
-    url = "https://api.deepinfra.com/v1/inference/black-forest-labs/FLUX-1-schnell"
-    payload = {"prompt": text}
-    headers = {"Authorization": f"Bearer {deep_infra_api_key}"}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    image_data_base64 = response.json()['images'][0].split(",")[1]
-    image_data = base64.b64decode(image_data_base64)
+    # The chunk-by-chunk parse can disagree with a whole-plan parse (e.g. a
+    # block opening with a colon-less prose line but containing a labeled
+    # line: the full parse merges them into the previous section, while the
+    # chunked parse matches the label as its own section). A mismatched
+    # prefetch would pair every later section with the wrong image, so verify
+    # the dispatched prompts against the final parse and discard the prefetch
+    # on any disagreement; the caller then takes the batched fetch path.
+    if with_images and task_prompts != [section.content for section in parse_sections(lesson_plan)]:
+        logger.warning("Streamed section parse diverged from final parse; discarding prefetched images")
+        for task in image_tasks:
+            task.cancel()
+        await asyncio.gather(*image_tasks, return_exceptions=True)
+        return lesson_plan, None
+
+    return lesson_plan, image_tasks
+
+# Run the full LLM + image pipeline in one event loop, so image requests
+# dispatched mid-stream are awaited before the loop is torn down. When a
+# job_id is given, every completed step is checkpointed and a retry resumes
+# from the last checkpoint. Images are often decorative and are the bulk of
+# the pipeline cost, so with_images=False skips them entirely.
+async def generate_lesson_plan_with_images(extracted_text: str, job_id: str = None, *, with_images: bool = True) -> tuple:
+    plan_bytes = _job_get(job_id, "plan.txt") if job_id else None
+
+    if plan_bytes is not None:
+        # Resume: the plan is already on disk; only fetch the missing images
+        logger.info(f"Resuming job {job_id} from checkpoint")
+        lesson_plan = plan_bytes.decode("utf-8")
+        if not with_images:
+            return lesson_plan, []
+        sections = parse_sections(lesson_plan)
+        results = [_job_get(job_id, f"img_{i}.jpg") for i in range(len(sections))]
+        misses = [i for i, data in enumerate(results) if data is None]
+        if misses:
+            fetched = await generate_images_from_texts([sections[i].content for i in misses])
+            for i, buf in zip(misses, fetched):
+                results[i] = buf.getvalue()
+                _job_put(job_id, f"img_{i}.jpg", results[i])
+        return lesson_plan, [BytesIO(data) for data in results]
+
+    lesson_plan, image_tasks = await generate_lesson_plan(extracted_text, with_images=with_images)
+    if job_id:
+        _job_put(job_id, "plan.txt", lesson_plan.encode("utf-8"))
+
+    if image_tasks is None:
+        # The streamed prefetch was discarded (chunked parse diverged from the
+        # final one); fetch all section images in a single batched call instead
+        sections = parse_sections(lesson_plan)
+        images = await generate_images_from_texts([section.content for section in sections])
+        for i, image in enumerate(images):
+            if job_id:
+                _job_put(job_id, f"img_{i}.jpg", image.getvalue())
+                image.seek(0)
+        return lesson_plan, images
+
+    images = []
+    for i, task in enumerate(image_tasks):
+        image = await task
+        if job_id:
+            _job_put(job_id, f"img_{i}.jpg", image.getvalue())
+            image.seek(0)
+        images.append(image)
+    return lesson_plan, images
+
+# Target render size for embedded images (see create_pdf)
+IMAGE_MAX_SIZE = (600, 450)
+
+# Prewarm size for the JPEG encode buffer: a 600x450 quality-85 JPEG is
+# comfortably under this, so the encoder's many small writes never trigger
+# a buffer reallocation
+IMAGE_BUFFER_PREWARM = 256 * 1024
+
+def _decode_image(image_b64: str) -> bytes:
+    """Decode one data-URL image from the FLUX response into embeddable bytes."""
+    # Slice past the data-URL prefix instead of split(), which would also
+    # materialize the prefix half of the multi-MB base64 string
+    image_data = base64.b64decode(image_b64[image_b64.index(",") + 1:], validate=False)
+    # PILImage.open only reads the header here, so checking the dimensions
+    # costs no pixel decode: an image already at render size is embedded
+    # as-is, skipping the full decode + re-encode round-trip entirely
     image = PILImage.open(BytesIO(image_data))
+    if image.format == "PNG" and image.width <= IMAGE_MAX_SIZE[0] and image.height <= IMAGE_MAX_SIZE[1]:
+        return image_data
+    # FLUX returns ~1024x1024 PNGs but the PDF renders at roughly 600x450 px;
+    # downscale and re-encode as JPEG so the output PDF shrinks 5-10x and
+    # ReportLab embeds far fewer bytes
+    image.thumbnail(IMAGE_MAX_SIZE, PILImage.LANCZOS)
+    # Grow the buffer to its expected final size up front, then overwrite from
+    # the start; truncate afterwards trims the tail at the encoder's end
+    # position. This avoids a realloc per growth step during the encode.
     buffer = BytesIO()
-    image.save(buffer, format="PNG")
+    buffer.write(b"\0" * IMAGE_BUFFER_PREWARM)
     buffer.seek(0)
-    logger.info("Image successfully generated")
-    return buffer
+    image.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+    buffer.truncate()
+    return buffer.getvalue()
+
+# Function to generate images based on the lesson plan content. All prompts
+# go out as a single batched inference request, amortizing the HTTP overhead
+# and letting the server batch them on the GPU; only cache misses are sent.
+@api_retry
+async def generate_images_from_texts(texts: list) -> list:
+    url = "https://api.deepinfra.com/v1/inference/black-forest-labs/FLUX-1-schnell"
+    results = [_cache_get(_cache_key("image", text)) for text in texts]
+    misses = [i for i, data in enumerate(results) if data is None]
+
+    if misses:
+        logger.info(f"Starting batched image generation for {len(misses)} prompt(s)")
+        payload = {"prompt": [texts[i] for i in misses]}
+        response = await get_http_client().post(url, json=payload)
+        response.raise_for_status()
+        for i, image_b64 in zip(misses, response.json()['images']):
+            results[i] = _decode_image(image_b64)
+            _cache_put(_cache_key("image", texts[i]), results[i])
+        logger.info("Images successfully generated")
+    else:
+        logger.info("All images served from cache")
+
+    return [BytesIO(data) for data in results]
+
+async def generate_image_from_text(text: str) -> BytesIO:
+    images = await generate_images_from_texts([text])
+    return images[0]
 
 # Function to create the PDF with proper formatting
 from reportlab.platypus import ListFlowable, ListItem
-def create_pdf(lesson_plan: str) -> BytesIO:
+
+# PDF styles, built once at import time. The old per-call approach mutated
+# ReportLab's shared sample styles on every invocation, which both repeated
+# the lookup work and corrupted the globals for any concurrent caller; these
+# private copies carry the customizations instead.
+_styles = getSampleStyleSheet()
+_title_style = _styles['Title']
+_heading_style = ParagraphStyle('LessonHeading', parent=_styles['Heading2'], alignment=1)  # Center the headings
+_bullet_style = _styles['Bullet']
+_body_style = ParagraphStyle('LessonBody', parent=_styles['BodyText'], alignment=4, leading=14)  # Justified, line-spaced
+
+def _image_flowable(image_buffer: BinaryIO) -> ReportLabImage:
+    """Build the centered image flowable for one section.
+
+    The buffer goes to ReportLab directly: the Image flowable wraps a
+    file-like in its own ImageReader and decodes it exactly once, and its
+    __init__ under reportlab 3.6.8 rejects a pre-built ImageReader outright.
+    """
+    img = ReportLabImage(image_buffer, width=8 * inch, height=3 * inch)
+    img.hAlign = 'CENTER'  # Center align the image
+    return img
+
+def render_section(section: Section, story: list):
+    """Append the flowables for one pre-parsed section to the story."""
+    # Add heading with heading style (bold)
+    story.append(Paragraph(f"<b>{section.heading}:</b>", _heading_style))
+    story.append(Spacer(1, 12))  # Add a small space after each heading
+
+    if section.bullets:
+        story.append(ListFlowable(
+            [ListItem(Paragraph(point, _bullet_style)) for point in section.bullets],
+            bulletType='bullet'
+        ))
+    for paragraph in section.paragraphs:
+        story.append(Paragraph(paragraph, _body_style))
+
+    story.append(Spacer(1, 12))  # Add a small space after each section of text
+
+async def create_pdf(lesson_plan: str, images: list = None, *, with_images: bool = True) -> BinaryIO:
     logger.info("Creating PDF document")
-    
-    # Buffer to store PDF in memory
-    buffer = BytesIO()
-    
+
+    # Buffer for the PDF output: small plans stay in memory, plans over 1 MB
+    # (several embedded PNGs) spill to disk instead of doubling peak RSS
+    buffer = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
     # Create a SimpleDocTemplate object
     doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
-    
-    # Get sample style sheet and define custom styles
-    styles = getSampleStyleSheet()
-    title_style = styles['Title']
-    heading_style = styles['Heading2']
-    bullet_style = styles['Bullet']
-    body_style = styles['BodyText']
-    
-    # Custom ParagraphStyle for better spacing and alignment
-    body_style.alignment = 4  # Justify the text
-    body_style.leading = 14    # Line spacing
-    heading_style.alignment = 1  # Center the headings
-    
+
     # List to store flowable elements for the PDF document
     story = []
     
     # Add a title to the document
-    story.append(Paragraph("Lesson Plan", title_style))
+    story.append(Paragraph("Lesson Plan", _title_style))
     story.append(Spacer(1, 24))  # Add space after the title
     
-    # Split the lesson plan into sections based on the newlines
-    sections = lesson_plan.split("\n\n")
-    
-    for section in sections:
-        if ':' in section:
-            # Separate heading and content
-            heading, content = section.split(":", 1)
-            
-            # Add heading to story with heading style (bold)
-            story.append(Paragraph(f"<b>{heading.strip()}:</b>", heading_style))
-            story.append(Spacer(1, 12))  # Add a small space after each heading
-            
-            # Check for bullet points and format appropriately
-            if "\n" in content.strip():
-                # If content contains line breaks, convert them into bullet points
-                bullet_points = content.strip().split("\n")
-                bullet_items = [ListItem(Paragraph(point.strip(), bullet_style)) for point in bullet_points]
-                story.append(ListFlowable(bullet_items, bulletType='bullet'))
-            else:
-                # Add body text to story with body text style for paragraphs
-                story.append(Paragraph(content.strip(), body_style))
-            
-            story.append(Spacer(1, 12))  # Add a small space after each section of text
-            
-            # Generate and add image based on the content (optional for visualization)
-            image_buffer = generate_image_from_text(content.strip())
-            img = ReportLabImage(image_buffer, width=8 * inch, height=3 * inch)
-            img.hAlign = 'CENTER'  # Center align the image
-            story.append(img)
+    # Parse the lesson plan into Section objects in one regex pass; all string
+    # splitting happens here, so rendering below only builds flowables
+    sections = parse_sections(lesson_plan)
+
+    # Use the images prefetched during streaming if available, otherwise fetch
+    # every section's image in a single batched inference call; text-only
+    # plans skip the image calls and flowables entirely
+    if with_images and images is None:
+        images = await generate_images_from_texts([section.content for section in sections])
+
+    for i, section in enumerate(sections):
+        render_section(section, story)
+
+        if with_images:
+            # Add the pre-generated image for this section (optional for visualization)
+            story.append(_image_flowable(images[i]))
             story.append(Spacer(1, 24))  # Add space after the image
     
-    # Build the PDF document
-    doc.build(story)
+    # Build the PDF document on a worker thread; the build is pure-Python CPU
+    # work and would otherwise block the event loop for other pending I/O
+    await asyncio.to_thread(doc.build, story)
     
     # Move buffer pointer to start so it can be returned as a response
     buffer.seek(0)
@@ -197,23 +581,34 @@ st.write("Upload a PDF, and we'll generate a detailed lesson plan based on the c
 # File upload functionality
 uploaded_file = st.file_uploader("Choose a PDF file", type=["pdf"])
 
+# Images are the bulk of the pipeline cost (one FLUX call per section);
+# a text-only plan needs just the single LLM call
+generate_images = st.checkbox("Generate an illustration for each section", value=True)
+
 if uploaded_file is not None:
     try:
         # Read file and extract text
         file_bytes = uploaded_file.read()
         extracted_text = extract_text_from_pdf(file_bytes)
-        
+
         if extracted_text:
-            # Generate lesson plan
-            lesson_plan = generate_lesson_plan(extracted_text)
+            # Generate lesson plan and section images in one pipelined pass,
+            # checkpointed under a job id derived from the uploaded bytes
+            lesson_plan, images = asyncio.run(run_with_http_client(
+                generate_lesson_plan_with_images(extracted_text, job_id=job_id_for(file_bytes), with_images=generate_images)
+            ))
             st.text_area("Generated Lesson Plan", lesson_plan, height=400)
 
             # Generate and download the PDF
             if st.button("Download Lesson Plan as PDF"):
-                pdf_buffer = create_pdf(lesson_plan)
+                pdf_buffer = asyncio.run(run_with_http_client(
+                    create_pdf(lesson_plan, images, with_images=generate_images)
+                ))
+                # Streamlit's download_button only accepts str/bytes/io types,
+                # not a SpooledTemporaryFile, so hand it the raw bytes
                 st.download_button(
                     label="Download PDF",
-                    data=pdf_buffer,
+                    data=pdf_buffer.read(),
                     file_name="lesson_plan.pdf",
                     mime="application/pdf"
                 )